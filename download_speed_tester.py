@@ -9,41 +9,19 @@ import threading
 import requests
 import time
 import socket
+import ssl
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-from datetime import datetime, timedelta
-from collections import deque
-from urllib.parse import urlparse
+from datetime import datetime
+from urllib.parse import urlsplit
 import sys
 import os
-from requests.adapters import HTTPAdapter
-from urllib3.util.connection import create_connection
 
-class CustomDNSAdapter(HTTPAdapter):
-    """自定义DNS适配器，用于重定向域名到指定IP"""
-    def __init__(self, hostname, custom_ip, *args, **kwargs):
-        self.hostname = hostname
-        self.custom_ip = custom_ip
-        super().__init__(*args, **kwargs)
-    
-    def init_poolmanager(self, *args, **kwargs):
-        # 创建自定义的连接函数
-        def patched_create_connection(address, *args, **kwargs):
-            host, port = address
-            if host == self.hostname:
-                # 将域名重定向到指定IP
-                address = (self.custom_ip, port)
-            return create_connection(address, *args, **kwargs)
-        
-        # 猴子补丁替换连接函数
-        original_create_connection = socket.create_connection
-        socket.create_connection = patched_create_connection
-        
-        try:
-            super().init_poolmanager(*args, **kwargs)
-        finally:
-            # 恢复原始函数
-            socket.create_connection = original_create_connection
+DOWNLOAD_THREAD_STACK_SIZE = 512 * 1024  # 下载线程栈大小
+SOCKET_RECV_BUFFER_SIZE = 4 * 1024 * 1024  # 下载socket的内核接收缓冲区大小
+LATENCY_PROBE_TIMEOUT = 0.5  # 延迟探测的连接超时（秒）
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
 
 class DownloadSpeedTester:
     def __init__(self, url, num_threads=32, test_duration=60, custom_ip=None):
@@ -52,39 +30,84 @@ class DownloadSpeedTester:
         self.test_duration = test_duration
         self.custom_ip = custom_ip
         
-        # 解析URL
-        self.parsed_url = urlparse(url)
-        self.hostname = self.parsed_url.hostname
-        self.port = self.parsed_url.port or (443 if self.parsed_url.scheme == 'https' else 80)
+        # 解析URL，生成请求和连接参数
+        self.set_target_url(url)
         
         # 确定目标IP和模式
         self.target_ip = custom_ip if custom_ip else None
         self.connection_mode = "指定IP" if custom_ip else "默认DNS解析"
         
         # 数据存储
-        self.download_speeds = deque()  # (timestamp, speed_mbps)
-        self.latencies = deque()        # (timestamp, latency_ms)
-        self.total_bytes = 0
+        # 每个列表只有一个写入线程，读取在所有线程结束后进行，无需加锁
+        # 时间记录为相对测试开始的秒数，绘图时再统一换算成时刻
+        self.download_speeds = []  # (elapsed_seconds, speed_mbps)
+        self.latencies = []        # (elapsed_seconds, latency_ms)
+        self.thread_bytes = [0] * num_threads  # 每个线程独立计数，只有一个写者，无需加锁
         self.start_time = None
+        self.start_datetime = None
         
         # 线程控制
         self.running = True
-        self.lock = threading.Lock()
         
-        # 会话配置
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        self.file_size = None  # 首个响应返回后得知的文件总大小
+        # 内核上限net.core.rmem_max不够时不设置SO_RCVBUF，保留Linux的接收缓冲区自动调节
+        try:
+            with open('/proc/sys/net/core/rmem_max') as f:
+                self.set_recv_buffer = int(f.read()) >= SOCKET_RECV_BUFFER_SIZE
+        except (OSError, ValueError):
+            self.set_recv_buffer = sys.platform != 'linux'
+    
+    def set_target_url(self, url):
+        """根据实际下载的URL设置主机、端口、原始HTTP请求和TLS参数"""
+        self.parsed_url = urlsplit(url)  # 与urlparse不同，路径中的;参数保留在path里
+        self.hostname = self.parsed_url.hostname
+        self.port = self.parsed_url.port or (443 if self.parsed_url.scheme == 'https' else 80)
         
-        # 如果指定了自定义IP，使用自定义DNS适配器
-        if custom_ip:
-            adapter = CustomDNSAdapter(self.hostname, custom_ip)
-            self.session.mount('http://', adapter)
-            self.session.mount('https://', adapter)
+        # 预先构造原始HTTP请求，下载线程直接通过socket收发，省去requests的逐块解析开销
+        path = self.parsed_url.path or '/'
+        if self.parsed_url.query:
+            path += '?' + self.parsed_url.query
+        # 请求头只差Range一行，由 build_request 按线程补全
+        self.request_prefix = (
+            f"GET {requests.utils.requote_uri(path)} HTTP/1.1\r\n"
+            f"Host: {self.parsed_url.netloc.rpartition('@')[2]}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Accept-Encoding: identity\r\n"  # 禁止压缩，统计的字节数即实际传输量
+            "Connection: keep-alive\r\n"
+        ).encode('ascii')
+        # 指定IP时只替换连接地址，请求路径、Host头和TLS SNI仍使用原始域名
+        self.connect_host = self.custom_ip or self.hostname
+        # 与requests使用同一份CA证书（certifi或REQUESTS_CA_BUNDLE），而不是系统证书库
+        if self.parsed_url.scheme == 'https':
+            cafile = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or requests.certs.where()
+            self.ssl_context = ssl.create_default_context(cafile=cafile)
+        else:
+            self.ssl_context = None
+    
+    def resolve_redirects(self):
+        """测试前跟随一次重定向，下载线程直接请求最终地址（原始socket请求不处理3xx）"""
+        # 用GET而不是HEAD，部分服务器对HEAD不做重定向或直接拒绝；只读响应头，不下载响应体
+        try:
+            with requests.get(self.url, stream=True, allow_redirects=True, timeout=10,
+                              headers={'User-Agent': USER_AGENT}) as response:
+                pass
+        except requests.RequestException as e:
+            print(f"检查重定向失败: {e}，使用原始链接")
+            return
+        if not response.history or response.url == self.url:
+            return
+        
+        print(f"下载链接重定向到: {response.url}")
+        if self.custom_ip and urlsplit(response.url).hostname != self.hostname:
+            # 指定的IP属于原始域名，重定向到其他主机后改用DNS解析
+            print("重定向目标不是原始域名，改用DNS自动解析")
+            self.custom_ip = None
+            self.target_ip = None
+            self.connection_mode = "默认DNS解析"
+        self.set_target_url(response.url)
         
     def get_target_ip(self):
-        """获取目标服务器IP地址"""
+        """获取目标服务器IP地址，解析结果作为之后所有连接和延迟探测的地址"""
         print(f"目标服务器: {self.hostname}")
         
         if self.custom_ip:
@@ -95,95 +118,262 @@ class DownloadSpeedTester:
                 resolved_ip = socket.gethostbyname(self.hostname)
                 print(f"连接模式: DNS解析 ({resolved_ip})")
                 self.target_ip = resolved_ip
+                # 只解析这一次，测试期间建连和延迟探测都不再做DNS查询
+                self.connect_host = resolved_ip
             except Exception as e:
                 print(f"DNS解析失败: {e}")
                 self.target_ip = "未知"
     
     def measure_latency(self):
-        """测量到目标服务器的延迟"""
+        """以TCP建连耗时测量到目标服务器的延迟（一个往返），超时或失败返回None
+        
+        连接已解析好的IP，计时中不包含DNS查询
+        """
         try:
-            start_time = time.time()
-            response = self.session.head(self.url, timeout=5)
-            end_time = time.time()
+            start_time = time.perf_counter()
+            sock = socket.create_connection((self.connect_host, self.port), timeout=LATENCY_PROBE_TIMEOUT)
+            end_time = time.perf_counter()
+            sock.close()
+            return (end_time - start_time) * 1000  # 转换为毫秒
+        except OSError:
+            return None
+    
+    def open_connection(self):
+        """建立到目标服务器的原始连接，HTTPS时完成TLS握手"""
+        error = None
+        for family, sock_type, proto, _, address in socket.getaddrinfo(
+                self.connect_host, self.port, type=socket.SOCK_STREAM):
+            sock = socket.socket(family, sock_type, proto)
+            try:
+                # 接收缓冲区需在连接前设置，才能在握手时协商到足够大的TCP窗口
+                if self.set_recv_buffer:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECV_BUFFER_SIZE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(10)
+                sock.connect(address)
+                break
+            except OSError as e:
+                sock.close()
+                error = e
+        else:
+            raise error
+        
+        # 立即回复ACK，避免延迟确认在高带宽时延积链路上拖慢发送端
+        if hasattr(socket, 'TCP_QUICKACK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        if self.ssl_context:
+            try:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.hostname)
+            except Exception:
+                sock.close()
+                raise
+        return sock
+    
+    def read_response_header(self, sock, buf, thread_id):
+        """读取响应头，返回 (响应体剩余字节数, 连接能否复用)，未知长度时剩余字节数为无穷大
+        
+        分块传输的响应体在这里一并读完，返回的剩余字节数为0
+        """
+        header = b''
+        while b'\r\n\r\n' not in header:
+            n = sock.recv_into(buf)
+            if not n:
+                raise ConnectionError("连接在响应头结束前被关闭")
+            header += buf[:n]
+        
+        header, body = header.split(b'\r\n\r\n', 1)
+        status_line, *header_lines = header.decode('latin-1').split('\r\n')
+        if not status_line.split()[1].startswith('2'):
+            raise ConnectionError(f"服务器返回 {status_line}")
+        
+        content_length = float('inf')
+        file_size = None
+        chunked = False
+        keep_alive = status_line.startswith('HTTP/1.1')
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                content_length = int(value)
+            elif name == 'content-range':
+                total = value.rpartition('/')[2].strip()
+                if total.isdigit():
+                    file_size = int(total)
+            elif name == 'connection':
+                keep_alive = value.strip().lower() == 'keep-alive'
+            elif name == 'transfer-encoding':
+                chunked = value.strip().lower().endswith('chunked')
+        
+        if chunked:
+            # 分块传输没有Content-Length，按块解析到结束块，连接可继续复用
+            return 0, self.read_chunked_body(sock, buf, thread_id, body) and keep_alive
+        
+        # 服务器忽略Range时返回完整文件，Content-Length即文件大小
+        if file_size is None and status_line.split()[1] == '200' and content_length != float('inf'):
+            file_size = content_length
+        if file_size and not self.file_size:
+            self.file_size = file_size
+        
+        # 与响应头一起收到的响应体数据也计入下载量
+        self.thread_bytes[thread_id] += len(body)
+        # 没有Content-Length时响应体以连接关闭为结束，无法复用
+        return content_length - len(body), keep_alive and content_length != float('inf')
+    
+    def read_chunked_body(self, sock, buf, thread_id, data):
+        """读取分块传输的响应体，data为随响应头收到的部分，完整读到结束块时返回True"""
+        thread_bytes = self.thread_bytes
+        while self.running:
+            # 块大小行（十六进制，可能带扩展参数）
+            while b'\r\n' not in data:
+                n = sock.recv_into(buf)
+                if not n:
+                    return False
+                data += buf[:n]
+            size_line, data = data.split(b'\r\n', 1)
+            size = int(size_line.split(b';', 1)[0], 16)
             
-            if response.status_code == 200:
-                latency = (end_time - start_time) * 1000  # 转换为毫秒
-                return latency
-        except:
-            pass
-        return None
+            if size == 0:
+                # 结束块之后是可选的trailer，以空行结束
+                while not (data.startswith(b'\r\n') or b'\r\n\r\n' in data):
+                    n = sock.recv_into(buf)
+                    if not n:
+                        return False
+                    data += buf[:n]
+                return True
+            
+            # 块数据及其后的CRLF，已收到的部分先计入，剩余部分直接读入缓冲区
+            left = size + 2
+            if len(data) >= left:
+                thread_bytes[thread_id] += size
+                data = data[left:]
+                continue
+            thread_bytes[thread_id] += min(len(data), size)
+            left -= len(data)
+            data = b''
+            while left and self.running:
+                n = sock.recv_into(buf, min(left, len(buf)))
+                if not n:
+                    return False
+                thread_bytes[thread_id] += min(n, max(0, left - 2))  # 不计块结尾的CRLF
+                left -= n
+        return False
+    
+    def build_request(self, thread_id):
+        """构造带Range的GET请求，文件大小已知时各线程从不同偏移开始下载"""
+        offset = thread_id * self.file_size // self.num_threads if self.file_size else 0
+        return self.request_prefix + b"Range: bytes=%d-\r\n\r\n" % offset
+    
+    def pin_thread_to_cpu(self, thread_id):
+        """将当前线程固定到一个CPU上（仅Linux），保持socket接收缓冲区的缓存局部性"""
+        if not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[thread_id % len(cpus)]})
+        except OSError:
+            pass  # 受限环境中无法设置亲和性时保持默认调度
     
     def download_chunk(self, thread_id):
-        """单个线程的下载函数"""
-        chunk_size = 8192
-        thread_bytes = 0
+        """单个线程的下载函数，数据读入复用的缓冲区后直接丢弃"""
+        self.pin_thread_to_cpu(thread_id)
+        chunk_size = 262144  # 256 KiB，减少Python层循环和系统调用次数
+        buf = bytearray(chunk_size)
+        request = None
+        request_file_size = None
         
         while self.running:
+            sock = None
             try:
-                # 使用流式下载
-                response = self.session.get(self.url, stream=True, timeout=10)
+                sock = self.open_connection()
+                recv_into = sock.recv_into  # 热循环中使用局部变量，省去每次的属性查找
+                thread_bytes = self.thread_bytes
+                keep_alive = True
                 
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if not self.running:
-                        break
+                # 在同一条持久连接上反复请求，避免每次重新进行TCP/TLS握手
+                while self.running and keep_alive:
+                    # 得知文件大小后改为从本线程的偏移开始请求，让服务器/CDN并行提供不同分片
+                    if request is None or request_file_size != self.file_size:
+                        request = self.build_request(thread_id)
+                        request_file_size = self.file_size
+                    sock.sendall(request)
+                    remaining, keep_alive = self.read_response_header(sock, buf, thread_id)
                     
-                    if chunk:
-                        chunk_len = len(chunk)
-                        thread_bytes += chunk_len
-                        
-                        with self.lock:
-                            self.total_bytes += chunk_len
-                
-                response.close()
+                    while self.running and remaining > 0:
+                        n = recv_into(buf)
+                        if not n:
+                            keep_alive = False
+                            break
+                        thread_bytes[thread_id] += n
+                        remaining -= n
                 
             except Exception as e:
                 print(f"线程 {thread_id} 遇到错误: {e}")
                 time.sleep(1)  # 出错后短暂休息
+            finally:
+                if sock:
+                    sock.close()
     
     def monitor_performance(self):
         """监控性能指标"""
         last_bytes = 0
-        last_time = time.time()
+        last_time = time.monotonic_ns()  # 单调时钟，不受系统时间调整影响
+        next_tick = last_time
+        status_format = ("\r时间: {:6.1f}s | 总下载: {:8.2f} MB | 实时速度: {:6.2f} MB/s | "
+                         "平均速度: {:6.2f} MB/s | 延迟: {}")
         
         while self.running:
-            time.sleep(1)  # 每秒采样一次
+            # 按固定节拍每秒采样一次，采样本身的耗时不会累积成漂移
+            next_tick += 1_000_000_000
+            now = time.monotonic_ns()
+            if next_tick < now:
+                # 落后超过一个周期时跳过错过的节拍，速度仍按实际间隔计算
+                next_tick = now
+            time.sleep((next_tick - now) / 1e9)
+            if not self.running:
+                break  # 测试已结束，不记录不完整的采样区间
             
-            current_time = time.time()
-            current_bytes = self.total_bytes
+            current_time = time.monotonic_ns()
+            current_bytes = sum(self.thread_bytes)
             
             # 计算下载速度
-            time_diff = current_time - last_time
+            time_diff = (current_time - last_time) / 1e9
             bytes_diff = current_bytes - last_bytes
             
             if time_diff > 0:
                 speed_bps = bytes_diff / time_diff
                 speed_mbps = speed_bps / (1024 * 1024)  # 转换为 MB/s
                 
-                timestamp = datetime.now()
-                
-                with self.lock:
-                    self.download_speeds.append((timestamp, speed_mbps))
+                elapsed = (current_time - self.start_time) / 1e9
+                self.download_speeds.append((elapsed, speed_mbps))
                     
-                # 测量延迟
-                latency = self.measure_latency()
-                if latency:
-                    with self.lock:
-                        self.latencies.append((timestamp, latency))
+                # 延迟由独立线程测量，这里只读取最近一次结果
+                latency = self.latencies[-1][1] if self.latencies else None
                 
                 # 打印实时信息
-                elapsed = current_time - self.start_time
                 total_mb = current_bytes / (1024 * 1024)
                 avg_speed = total_mb / elapsed if elapsed > 0 else 0
                 
-                print(f"\r时间: {elapsed:6.1f}s | "
-                      f"总下载: {total_mb:8.2f} MB | "
-                      f"实时速度: {speed_mbps:6.2f} MB/s | "
-                      f"平均速度: {avg_speed:6.2f} MB/s | "
-                      f"延迟: {latency:6.1f}ms" if latency else "延迟: N/A", end="")
+                latency_text = f"{latency:6.1f}ms" if latency else "   N/A"
+                sys.stdout.write(status_format.format(elapsed, total_mb, speed_mbps, avg_speed, latency_text))
+                sys.stdout.flush()
             
             last_bytes = current_bytes
             last_time = current_time
     
+    def monitor_latency(self):
+        """在独立线程中每秒测量一次延迟，避免阻塞速度采样"""
+        while self.running:
+            latency = self.measure_latency()
+            if latency:
+                self.latencies.append(((time.monotonic_ns() - self.start_time) / 1e9, latency))
+            time.sleep(1)
+    
+    def samples_to_arrays(self, samples):
+        """将 (elapsed_seconds, value) 采样一次性转换为NumPy数组，时间轴换算为Matplotlib日期数值"""
+        data = np.array(samples, dtype=np.float64)
+        times = mdates.date2num(self.start_datetime) + data[:, 0] / 86400.0
+        return times, data[:, 1]
+    
     def create_charts(self):
         """创建性能图表"""
         plt.rcParams['font.sans-serif'] = ['SimHei', 'DejaVu Sans']
@@ -193,7 +383,7 @@ class DownloadSpeedTester:
         
         # 下载速度图表
         if self.download_speeds:
-            times, speeds = zip(*self.download_speeds)
+            times, speeds = self.samples_to_arrays(self.download_speeds)
             ax1.plot(times, speeds, 'b-', linewidth=1.5, alpha=0.8)
             ax1.fill_between(times, speeds, alpha=0.3)
             title = f'下载速度波动图 - {self.hostname} | {self.connection_mode}: {self.target_ip}'
@@ -203,10 +393,8 @@ class DownloadSpeedTester:
             ax1.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
             ax1.xaxis.set_major_locator(mdates.SecondLocator(interval=10))
             
-            # 添加统计信息
-            avg_speed = sum(speeds) / len(speeds)
-            max_speed = max(speeds)
-            min_speed = min(speeds)
+            # 添加统计信息（NumPy在连续内存上做归约，长时间测试时避免逐元素的Python循环）
+            min_speed, max_speed, avg_speed = speeds.min(), speeds.max(), speeds.mean()
             ax1.axhline(y=avg_speed, color='r', linestyle='--', alpha=0.7, label=f'平均: {avg_speed:.2f} MB/s')
             ax1.legend()
             
@@ -217,7 +405,7 @@ class DownloadSpeedTester:
         
         # 延迟图表
         if self.latencies:
-            times, lats = zip(*self.latencies)
+            times, lats = self.samples_to_arrays(self.latencies)
             ax2.plot(times, lats, 'r-', linewidth=1.5, alpha=0.8)
             ax2.fill_between(times, lats, alpha=0.3, color='red')
             title2 = f'网络延迟波动图 - {self.connection_mode}: {self.target_ip}'
@@ -229,9 +417,7 @@ class DownloadSpeedTester:
             ax2.xaxis.set_major_locator(mdates.SecondLocator(interval=10))
             
             # 添加延迟统计信息
-            avg_lat = sum(lats) / len(lats)
-            max_lat = max(lats)
-            min_lat = min(lats)
+            min_lat, max_lat, avg_lat = lats.min(), lats.max(), lats.mean()
             ax2.axhline(y=avg_lat, color='g', linestyle='--', alpha=0.7, label=f'平均: {avg_lat:.1f} ms')
             ax2.legend()
             
@@ -257,7 +443,8 @@ class DownloadSpeedTester:
         print("多线程下载速度测试工具")
         print("=" * 60)
         
-        # 获取目标IP
+        # 跟随重定向并获取目标IP
+        self.resolve_redirects()
         self.get_target_ip()
         
         print(f"下载链接: {self.url}")
@@ -265,20 +452,32 @@ class DownloadSpeedTester:
         print(f"测试时长: {self.test_duration} 秒")
         print("=" * 60)
         
-        self.start_time = time.time()
+        self.start_time = time.monotonic_ns()
+        self.start_datetime = datetime.now()
         
         # 启动监控线程
         monitor_thread = threading.Thread(target=self.monitor_performance)
         monitor_thread.daemon = True
         monitor_thread.start()
         
+        # 启动延迟测量线程
+        latency_thread = threading.Thread(target=self.monitor_latency)
+        latency_thread.daemon = True
+        latency_thread.start()
+        
         # 启动下载线程
+        # 下载线程只做阻塞的recv_into（期间释放GIL），调用栈很浅，
+        # 缩小线程栈以降低大量并发线程预留的内存
         download_threads = []
-        for i in range(self.num_threads):
-            thread = threading.Thread(target=self.download_chunk, args=(i,))
-            thread.daemon = True
-            thread.start()
-            download_threads.append(thread)
+        previous_stack_size = threading.stack_size(DOWNLOAD_THREAD_STACK_SIZE)
+        try:
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self.download_chunk, args=(i,))
+                thread.daemon = True
+                thread.start()
+                download_threads.append(thread)
+        finally:
+            threading.stack_size(previous_stack_size)
         
         print("测试进行中...")
         print("实时数据:")
@@ -286,13 +485,15 @@ class DownloadSpeedTester:
         # 等待测试完成
         time.sleep(self.test_duration)
         
-        # 停止所有线程
+        # 停止所有线程，等待采样线程写完最后一个数据点
         self.running = False
+        monitor_thread.join(timeout=2)
+        latency_thread.join(timeout=2)
         
         print("\n\n测试完成！正在生成报告...")
         
         # 最终统计
-        total_mb = self.total_bytes / (1024 * 1024)
+        total_mb = sum(self.thread_bytes) / (1024 * 1024)
         avg_speed = total_mb / self.test_duration
         
         print("\n" + "=" * 60)
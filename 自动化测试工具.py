@@ -9,45 +9,77 @@ import threading
 import requests
 import time
 import socket
+import ssl
+import sys
+import os
+import matplotlib
+# 无图形界面时使用非交互式Agg后端，只保存图片不弹出窗口
+HEADLESS = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+if HEADLESS:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from datetime import datetime, timedelta
 from collections import deque
-from urllib.parse import urlparse
-import sys
-import os
+from urllib.parse import urlparse, urlunparse
 from requests.adapters import HTTPAdapter
-from urllib3.util.connection import create_connection
+from urllib3.connection import HTTPConnection
 import json
+import queue
+import struct
+import functools
+
+DOWNLOAD_THREAD_STACK_SIZE = 512 * 1024  # 下载线程栈大小
+SOCKET_RECV_BUFFER_SIZE = 8 << 20  # 每个连接的socket接收缓冲区大小
+TCP_INFO_SIZE = 104       # Linux struct tcp_info 中读取到 tcpi_total_retrans 为止的长度
+TCP_INFO_RTT_OFFSET = 68  # tcpi_rtt（微秒）在 struct tcp_info 中的偏移
+# AES-NI上AES128-GCM的解密开销约为AES256-GCM的一半
+# TLS 1.3的加密套件无法通过set_ciphers指定，使用时连接限制为TLS 1.2
+FAST_TLS_CIPHERS = 'ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256'
+
+@functools.lru_cache(maxsize=None)
+def recv_buffer_allowed():
+    """判断内核是否允许设置足够大的接收缓冲区（结果缓存，只读取一次/proc）
+    
+    SO_RCVBUF会被net.core.rmem_max截断，且设置后关闭Linux的缓冲区自动调节，
+    上限不足时保持自动调节反而更快
+    """
+    try:
+        with open('/proc/sys/net/core/rmem_max') as f:
+            return int(f.read()) >= SOCKET_RECV_BUFFER_SIZE
+    except (OSError, ValueError):
+        return sys.platform != 'linux'
+
+class SSLContextAdapter(HTTPAdapter):
+    """可指定SSLContext的适配器，用于自定义TLS加密套件，并为新连接设置socket选项"""
+    def __init__(self, *args, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs['ssl_context'] = self.ssl_context
+        # 默认选项已包含TCP_NODELAY；接收缓冲区在连接前设置，握手时即可协商到足够大的TCP窗口
+        if recv_buffer_allowed():
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECV_BUFFER_SIZE)
+            ]
+        super().init_poolmanager(*args, **kwargs)
 
-class CustomDNSAdapter(HTTPAdapter):
-    """自定义DNS适配器，用于重定向域名到指定IP"""
-    def __init__(self, hostname, custom_ip, *args, **kwargs):
+class CustomDNSAdapter(SSLContextAdapter):
+    """自定义DNS适配器，请求直接发往指定IP，TLS的SNI和证书校验仍使用原域名"""
+    def __init__(self, hostname, *args, **kwargs):
         self.hostname = hostname
-        self.custom_ip = custom_ip
         super().__init__(*args, **kwargs)
     
     def init_poolmanager(self, *args, **kwargs):
-        # 创建自定义的连接函数
-        def patched_create_connection(address, *args, **kwargs):
-            host, port = address
-            if host == self.hostname:
-                # 将域名重定向到指定IP
-                address = (self.custom_ip, port)
-            return create_connection(address, *args, **kwargs)
-        
-        # 猴子补丁替换连接函数
-        original_create_connection = socket.create_connection
-        socket.create_connection = patched_create_connection
-        
-        try:
-            super().init_poolmanager(*args, **kwargs)
-        finally:
-            # 恢复原始函数
-            socket.create_connection = original_create_connection
+        # 通过连接池参数指定主机名，不修改全局的socket函数，多线程下安全
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
 
 class AdvancedDownloadTester:
-    def __init__(self, url, custom_ip=None):
+    def __init__(self, url, custom_ip=None, max_threads=200, fast_cipher=False):
         self.url = url
         self.custom_ip = custom_ip
         
@@ -60,13 +92,63 @@ class AdvancedDownloadTester:
         self.target_ip = custom_ip if custom_ip else None
         self.connection_mode = "指定IP" if custom_ip else "DNS解析"
         
+        # 所有会话共享同一个连接池适配器，连接和TLS握手在各线程、各次测试间复用
+        # 池大小按最大线程数设置，额外一个连接留给延迟测量
+        self.pool_size = max_threads + 1
+        self.ssl_context = None
+        if fast_cipher:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.set_ciphers(FAST_TLS_CIPHERS)
+            self.ssl_context.maximum_version = ssl.TLSVersion.TLSv1_2
+        
+        if custom_ip:
+            self.bind_ip(custom_ip)
+        else:
+            self.use_dns()
+        
+        # 空闲会话，线程结束时归还，供后续测试（如极限并发测试的各轮）复用
+        self.idle_sessions = queue.SimpleQueue()
+        
         # 测试结果存储
         self.test_results = {}  # 存储不同测试的结果
         
+    def use_dns(self):
+        """按原始URL请求，每个新连接自行DNS解析（需在创建会话前调用）"""
+        self.request_url = self.url
+        self.host_header = None
+        self.adapter = SSLContextAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                                         pool_block=True, ssl_context=self.ssl_context)
+    
+    def bind_ip(self, ip):
+        """请求直接发往指定IP，Host头、SNI和证书校验保留原域名（需在创建会话前调用）"""
+        self.request_url = urlunparse(self.parsed_url._replace(netloc=f"{ip}:{self.port}"))
+        self.host_header = self.parsed_url.netloc.rpartition('@')[2]
+        self.adapter = CustomDNSAdapter(self.hostname, pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                                        pool_block=True, ssl_context=self.ssl_context)
+    
+    def redirects_off_host(self):
+        """检查下载链接是否重定向到其他主机（固定Host头后无法跟随跨主机重定向）"""
+        try:
+            response = requests.head(self.url, allow_redirects=False, timeout=5)
+        except requests.RequestException:
+            return False
+        location = response.headers.get('Location')
+        if not response.is_redirect or not location:
+            return False
+        return urlparse(location).hostname not in (None, self.hostname)
+    
     def get_target_ip(self):
         """获取目标服务器IP地址"""
         print(f"目标服务器: {self.hostname}")
         
+        off_host = self.redirects_off_host()
+        if self.custom_ip and off_host:
+            # 指定的IP属于原始域名，重定向到其他主机后改用DNS解析
+            print("下载链接重定向到其他主机，指定IP不适用，改用DNS自动解析")
+            self.custom_ip = None
+            self.connection_mode = "DNS解析"
+            self.use_dns()
+        
         if self.custom_ip:
             print(f"连接模式: 指定IP ({self.custom_ip})")
             self.target_ip = self.custom_ip
@@ -78,28 +160,46 @@ class AdvancedDownloadTester:
             except Exception as e:
                 print(f"DNS解析失败: {e}")
                 self.target_ip = "未知"
+                return
+            
+            # 缓存解析结果，测试期间所有新连接直接使用该IP，不再逐次DNS查询
+            if off_host:
+                print("下载链接重定向到其他主机，保持逐连接DNS解析")
+            else:
+                self.bind_ip(resolved_ip)
     
     def create_session(self):
-        """创建HTTP会话"""
+        """创建HTTP会话（Session非线程安全，每个线程各用一个，底层共享连接池适配器）"""
         session = requests.Session()
         session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept-Encoding': 'identity'  # 禁止压缩，统计的字节数即实际传输量
         })
+        if self.host_header:
+            session.headers['Host'] = self.host_header
         
-        # 如果指定了自定义IP，使用自定义DNS适配器
-        if self.custom_ip:
-            adapter = CustomDNSAdapter(self.hostname, self.custom_ip)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
         
         return session
     
+    def acquire_session(self):
+        """取出一个空闲会话，没有则新建；同一会话同一时刻只被一个线程使用"""
+        try:
+            return self.idle_sessions.get_nowait()
+        except queue.Empty:
+            return self.create_session()
+    
+    def release_session(self, session):
+        """线程结束时归还会话"""
+        self.idle_sessions.put(session)
+    
     def measure_latency(self, session):
         """测量到目标服务器的延迟"""
         try:
-            start_time = time.time()
-            response = session.head(self.url, timeout=5)
-            end_time = time.time()
+            start_time = time.perf_counter()
+            response = session.head(self.request_url, timeout=5)
+            end_time = time.perf_counter()
             
             if response.status_code == 200:
                 latency = (end_time - start_time) * 1000  # 转换为毫秒
@@ -108,62 +208,126 @@ class AdvancedDownloadTester:
             pass
         return None
     
+    def read_tcp_rtt(self, sock):
+        """从活动连接的TCP_INFO读取内核平滑RTT（仅Linux），不产生额外请求，失败返回None"""
+        if sock is None or not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+            rtt_us = struct.unpack_from('I', info, TCP_INFO_RTT_OFFSET)[0]
+        except (OSError, struct.error):
+            return None  # 连接已关闭等情况，改用HEAD请求测量
+        return rtt_us / 1000 if rtt_us else None
+    
+    def restrict_cpu_affinity(self, num_threads):
+        """把当前线程限制在前num_threads个可用CPU上（仅Linux），返回原来的CPU集合，未修改时返回None"""
+        if not hasattr(os, 'sched_setaffinity'):
+            return None
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+            if num_threads >= len(cpus):
+                return None
+            os.sched_setaffinity(0, cpus[:num_threads])
+        except OSError:
+            return None  # 受限环境中无法设置亲和性时保持默认调度
+        return set(cpus)
+    
     def single_test(self, num_threads, test_duration, test_name):
         """执行单次测试"""
         print(f"\n开始测试: {test_name}")
         print(f"线程数: {num_threads}, 时长: {test_duration}秒")
         print("-" * 50)
         
-        # 数据存储
-        download_speeds = deque()
-        latencies = deque()
-        total_bytes = 0
-        start_time = time.time()
-        running = True
+        # 数据存储，每秒一个采样，按测试时长限定容量
+        download_speeds = deque(maxlen=test_duration + 2)
+        latencies = deque(maxlen=test_duration + 2)
+        thread_bytes = [0] * num_threads  # 每个线程独立计数，只有一个写者，无需加锁
+        # 监控线程边采样边累计的统计值，测试结束后无需再遍历采样队列
+        max_speed = 0
+        min_speed = None
+        latency_sum = 0
+        latency_count = 0
+        # 计时统一使用单调时钟，采样时间记录为相对开始的秒数，绘图时再换算成时刻
+        start_time = time.monotonic()
+        start_datetime = datetime.now()
+        stop = threading.Event()  # 测试结束信号，主线程设置后各线程退出
+        probe_socket = None  # 0号下载线程当前使用的socket，用于被动读取RTT
+        latest_status = None  # 监控线程生成的最新状态行，由显示线程输出
         lock = threading.Lock()
         
-        # 创建会话
-        session = self.create_session()
-        
         def download_chunk(thread_id):
             """单个线程的下载函数"""
-            nonlocal total_bytes, running
-            chunk_size = 8192
-            thread_bytes = 0
+            nonlocal probe_socket
+            stopped = stop.is_set
+            chunk_size = 1 << 20  # 1 MiB，减少Python层循环次数
+            buf = bytearray(chunk_size)  # 每个线程复用同一个缓冲区
+            thread_session = self.acquire_session()
             
-            while running:
+            while not stopped():
                 try:
-                    response = session.get(self.url, stream=True, timeout=10)
-                    
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        if not running:
-                            break
+                    # 出错时也会及时关闭响应，连接不会滞留到垃圾回收时才归还连接池
+                    with thread_session.get(self.request_url, stream=True, timeout=10) as response:
+                        if thread_id == 0:
+                            connection = response.raw.connection
+                            probe_socket = connection.sock if connection else None
                         
-                        if chunk:
-                            chunk_len = len(chunk)
-                            thread_bytes += chunk_len
-                            
-                            with lock:
-                                total_bytes += chunk_len
-                    
-                    response.close()
+                        # 直接从底层响应读取，跳过iter_content的生成器和逐块判断
+                        raw = response.raw
+                        # 统计的是传输的字节数，数据直接丢弃，因此即使服务器忽略identity返回压缩数据也不解压，
+                        # 统一从底层的http.client响应读取，不依赖urllib3的版本
+                        body = raw._fp
+                        if body.length is not None:
+                            # 已知长度的响应体直接读入复用的缓冲区，不产生bytes对象。
+                            # http.client的readinto会读到缓冲区填满才返回，这里改用底层读取器的
+                            # readinto1，有数据即返回，剩余长度自行维护
+                            readinto1 = body.fp.readinto1
+                            view = memoryview(buf)
+                            remaining = body.length
+                            while remaining and not stopped():
+                                n = readinto1(view if remaining >= chunk_size else view[:remaining])
+                                if not n:
+                                    raise ConnectionError("响应体未读完连接已关闭")
+                                remaining -= n
+                                thread_bytes[thread_id] += n
+                            body.length = remaining
+                            if not remaining:
+                                body.close()
+                                raw.release_conn()  # 响应体已读完，连接归还连接池
+                        else:
+                            # 分块传输或以关闭连接结束的响应体，交给http.client解析；
+                            # read1同样有数据即返回，chunk_size仅为单次读取上限
+                            read1 = body.read1
+                            while not stopped():
+                                chunk = read1(chunk_size)
+                                if not chunk:
+                                    raw.release_conn()  # 响应体已读完，连接归还连接池
+                                    break
+                                thread_bytes[thread_id] += len(chunk)
                     
                 except Exception as e:
-                    if running:  # 只在测试进行中打印错误
+                    if not stopped():  # 只在测试进行中打印错误
                         print(f"线程 {thread_id} 遇到错误: {e}")
-                    time.sleep(1)
+                    stop.wait(1)
+            
+            self.release_session(thread_session)
         
         def monitor_performance():
             """监控性能指标"""
-            nonlocal total_bytes, running
+            nonlocal max_speed, min_speed, latency_sum, latency_count, latest_status
+            session = self.acquire_session()  # 延迟测量使用单独的会话
             last_bytes = 0
-            last_time = time.time()
+            last_time = start_time
+            tick = 0
             
-            while running:
-                time.sleep(1)
-                
-                current_time = time.time()
-                current_bytes = total_bytes
+            while True:
+                # 第k次采样安排在开始后第k秒，与主线程的结束时刻对齐，
+                # 结束恰好落在节拍上时最后一秒的采样不会被丢弃
+                tick += 1
+                finished = stop.wait(max(0, start_time + tick - time.monotonic()))
+                current_time = time.monotonic()
+                if finished and current_time - last_time < 0.5:
+                    break  # 测试已结束，剩余区间不足半个节拍，不记录不完整的采样
+                current_bytes = sum(thread_bytes)
                 
                 time_diff = current_time - last_time
                 bytes_diff = current_bytes - last_bytes
@@ -172,47 +336,85 @@ class AdvancedDownloadTester:
                     speed_bps = bytes_diff / time_diff
                     speed_mbps = speed_bps / (1024 * 1024)
                     
-                    timestamp = datetime.now()
+                    elapsed = current_time - start_time
                     
                     with lock:
-                        download_speeds.append((timestamp, speed_mbps))
+                        download_speeds.append((elapsed, speed_mbps))
+                    max_speed = max(max_speed, speed_mbps)
+                    min_speed = speed_mbps if min_speed is None else min(min_speed, speed_mbps)
                     
-                    # 测量延迟
-                    latency = self.measure_latency(session)
+                    # 测量延迟：优先读取下载连接的内核RTT，不占用连接池也不受排队影响
+                    latency = self.read_tcp_rtt(probe_socket)
+                    if latency is None:
+                        latency = self.measure_latency(session)
                     if latency:
                         with lock:
-                            latencies.append((timestamp, latency))
+                            latencies.append((elapsed, latency))
+                        latency_sum += latency
+                        latency_count += 1
                     
-                    # 打印实时信息
-                    elapsed = current_time - start_time
+                    # 生成实时信息，只替换引用，输出交给显示线程
                     total_mb = current_bytes / (1024 * 1024)
                     avg_speed = total_mb / elapsed if elapsed > 0 else 0
+                    latency_text = f"{latency:6.1f}ms" if latency else "N/A"
                     
-                    print(f"\r时间: {elapsed:6.1f}s | "
-                          f"总下载: {total_mb:8.2f} MB | "
-                          f"实时速度: {speed_mbps:6.2f} MB/s | "
-                          f"平均速度: {avg_speed:6.2f} MB/s | "
-                          f"延迟: {latency:6.1f}ms" if latency else "延迟: N/A", end="")
+                    latest_status = (f"\r时间: {elapsed:6.1f}s | "
+                                     f"总下载: {total_mb:8.2f} MB | "
+                                     f"实时速度: {speed_mbps:6.2f} MB/s | "
+                                     f"平均速度: {avg_speed:6.2f} MB/s | "
+                                     f"延迟: {latency_text}")
                 
                 last_bytes = current_bytes
                 last_time = current_time
-        
-        # 启动监控线程
+                if finished:
+                    break
+            
+            self.release_session(session)
+        
+        def render_status():
+            """每500ms把最新状态行写到stderr，与测试结果输出分开"""
+            shown = None
+            while not stop.wait(0.5):
+                status = latest_status
+                if status is not shown:
+                    sys.stderr.write(status)
+                    sys.stderr.flush()
+                    shown = status
+        
+        # 启动监控线程和状态显示线程
         monitor_thread = threading.Thread(target=monitor_performance)
         monitor_thread.daemon = True
         monitor_thread.start()
+        render_thread = threading.Thread(target=render_status)
+        render_thread.daemon = True
+        render_thread.start()
         
         # 启动下载线程
+        # 下载线程大部分时间阻塞在socket读取上（期间释放GIL），调用栈很浅，
+        # 缩小线程栈以降低极限并发测试中上百个线程预留的内存
+        # 新线程继承创建者的CPU亲和性，线程数少于CPU数时只在部分核心上运行，减少调度迁移
         download_threads = []
-        for i in range(num_threads):
-            thread = threading.Thread(target=download_chunk, args=(i,))
-            thread.daemon = True
-            thread.start()
-            download_threads.append(thread)
+        previous_stack_size = threading.stack_size(DOWNLOAD_THREAD_STACK_SIZE)
+        previous_cpus = self.restrict_cpu_affinity(num_threads)
+        try:
+            for i in range(num_threads):
+                thread = threading.Thread(target=download_chunk, args=(i,))
+                thread.daemon = True
+                thread.start()
+                download_threads.append(thread)
+        finally:
+            threading.stack_size(previous_stack_size)
+            if previous_cpus:
+                os.sched_setaffinity(0, previous_cpus)
         
-        # 等待测试完成
-        time.sleep(test_duration)
-        running = False
+        # 等待测试完成，时长从开始计时算起，不受启动大量线程耗时的影响
+        try:
+            stop.wait(max(0, start_time + test_duration - time.monotonic()))
+        finally:
+            stop.set()  # Ctrl-C中断时同样通知所有线程退出
+        total_bytes = sum(thread_bytes)  # 在等待监控线程前取值，不计入停止后仍在读取的数据
+        monitor_thread.join(timeout=6)  # 等待监控线程停止写入，结果中直接保存采样队列
+        render_thread.join(timeout=1)
         
         # 计算最终统计
         total_mb = total_bytes / (1024 * 1024)
@@ -222,19 +424,20 @@ class AdvancedDownloadTester:
         self.test_results[test_name] = {
             'threads': num_threads,
             'duration': test_duration,
+            'start_datetime': start_datetime,
             'total_mb': total_mb,
             'avg_speed': avg_speed,
-            'download_speeds': list(download_speeds),
-            'latencies': list(latencies),
-            'max_speed': max([speed for _, speed in download_speeds]) if download_speeds else 0,
-            'min_speed': min([speed for _, speed in download_speeds]) if download_speeds else 0,
-            'avg_latency': sum([lat for _, lat in latencies]) / len(latencies) if latencies else 0
+            'download_speeds': download_speeds,
+            'latencies': latencies,
+            'max_speed': max_speed,
+            'min_speed': min_speed or 0,
+            'avg_latency': latency_sum / latency_count if latency_count else 0
         }
         
         print(f"\n{test_name} 完成!")
         print(f"总下载: {total_mb:.2f} MB, 平均速度: {avg_speed:.2f} MB/s")
         
-        session.close()
+        # 会话共享的适配器需在各次测试间保持连接，这里不关闭会话
         return self.test_results[test_name]
     
     def find_max_concurrent_connections(self, max_test_threads=200, step=10, test_duration=10):
@@ -247,6 +450,7 @@ class AdvancedDownloadTester:
         max_connections = 1
         best_speed = 0
         concurrent_results = []
+        recent_speeds = deque(maxlen=3)  # 最近三次的平均速度，用于检测性能下降
         
         current_threads = 1
         while current_threads <= max_test_threads:
@@ -269,12 +473,12 @@ class AdvancedDownloadTester:
                     max_connections = current_threads
                 
                 # 如果连续几次速度下降明显，可能达到瓶颈
-                if len(concurrent_results) >= 3:
-                    recent_speeds = [r['speed'] for r in concurrent_results[-3:]]
-                    if all(recent_speeds[i] >= recent_speeds[i+1] for i in range(len(recent_speeds)-1)):
-                        if recent_speeds[0] - recent_speeds[-1] > best_speed * 0.1:  # 下降超过10%
-                            print(f"\n检测到性能下降，建议最大并发: {max_connections} 线程")
-                            break
+                recent_speeds.append(avg_speed)
+                if len(recent_speeds) == 3:
+                    first, middle, last = recent_speeds
+                    if first >= middle >= last and first - last > best_speed * 0.1:  # 下降超过10%
+                        print(f"\n检测到性能下降，建议最大并发: {max_connections} 线程")
+                        break
                 
             except Exception as e:
                 print(f"✗ {current_threads} 线程测试失败: {e}")
@@ -301,8 +505,8 @@ class AdvancedDownloadTester:
         speeds = [r['speed'] for r in concurrent_results]
         
         # 绘制线图和散点图
-        ax.plot(threads, speeds, 'b-o', linewidth=2, markersize=6, alpha=0.8)
-        ax.fill_between(threads, speeds, alpha=0.3)
+        ax.plot(threads, speeds, 'b-o', linewidth=2, markersize=6, alpha=0.8, rasterized=True)
+        ax.fill_between(threads, speeds, alpha=0.3, rasterized=True)
         
         # 标记最佳点
         optimal_speed = max(speeds)
@@ -326,9 +530,11 @@ class AdvancedDownloadTester:
         plt.tight_layout()
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"concurrent_test_{self.hostname}_{timestamp}.png"
-        plt.savefig(filename, dpi=300, bbox_inches='tight')
+        plt.savefig(filename, dpi=150, bbox_inches='tight')
         print(f"\n并发测试图表已保存: {filename}")
-        plt.show()
+        if not HEADLESS:
+            plt.show()
+        plt.close(fig)
     
     def create_comparison_chart(self, test_configs):
         """创建对比图表"""
@@ -345,9 +551,10 @@ class AdvancedDownloadTester:
         # 1. 下载速度对比图
         for i, (test_name, result) in enumerate(self.test_results.items()):
             if result['download_speeds']:
-                times, speeds = zip(*result['download_speeds'])
+                times = [result['start_datetime'] + timedelta(seconds=t) for t, _ in result['download_speeds']]
+                speeds = [speed for _, speed in result['download_speeds']]
                 ax1.plot(times, speeds, color=colors[i % len(colors)], 
-                        linewidth=1.5, label=f"{test_name} ({result['threads']}线程)", alpha=0.8)
+                        linewidth=1.5, label=f"{test_name} ({result['threads']}线程)", alpha=0.8, rasterized=True)
         
         ax1.set_title(f'下载速度对比 - {self.hostname} | {self.connection_mode}: {self.target_ip}', 
                      fontsize=12, fontweight='bold')
@@ -359,9 +566,10 @@ class AdvancedDownloadTester:
         # 2. 延迟对比图
         for i, (test_name, result) in enumerate(self.test_results.items()):
             if result['latencies']:
-                times, lats = zip(*result['latencies'])
+                times = [result['start_datetime'] + timedelta(seconds=t) for t, _ in result['latencies']]
+                lats = [lat for _, lat in result['latencies']]
                 ax2.plot(times, lats, color=colors[i % len(colors)], 
-                        linewidth=1.5, label=f"{test_name}", alpha=0.8)
+                        linewidth=1.5, label=f"{test_name}", alpha=0.8, rasterized=True)
         
         ax2.set_title('网络延迟对比', fontsize=12, fontweight='bold')
         ax2.set_ylabel('延迟 (ms)', fontsize=10)
@@ -392,21 +600,20 @@ class AdvancedDownloadTester:
         ax4.axis('tight')
         ax4.axis('off')
         
-        table_data = []
         headers = ['测试名称', '线程数', '时长(s)', '总下载(MB)', '平均速度(MB/s)', '最高速度(MB/s)', '平均延迟(ms)']
-        
-        for test_name, result in self.test_results.items():
-            table_data.append([
-                test_name,
-                str(result['threads']),
-                str(result['duration']),
-                f"{result['total_mb']:.2f}",
-                f"{result['avg_speed']:.2f}",
-                f"{result['max_speed']:.2f}",
-                f"{result['avg_latency']:.1f}" if result['avg_latency'] > 0 else "N/A"
-            ])
-        
-        table = ax4.table(cellText=table_data, colLabels=headers, cellLoc='center', loc='center')
+        col_widths = [0.22, 0.09, 0.09, 0.14, 0.16, 0.16, 0.14]  # 固定列宽，跳过matplotlib的自动列宽计算
+        fmt2 = '{:.2f}'.format
+        fmt1 = '{:.1f}'.format
+        
+        table_data = [
+            [test_name, str(result['threads']), str(result['duration']),
+             fmt2(result['total_mb']), fmt2(result['avg_speed']), fmt2(result['max_speed']),
+             fmt1(result['avg_latency']) if result['avg_latency'] > 0 else "N/A"]
+            for test_name, result in self.test_results.items()
+        ]
+        
+        table = ax4.table(cellText=table_data, colLabels=headers, colWidths=col_widths,
+                          cellLoc='center', loc='center')
         table.auto_set_font_size(False)
         table.set_fontsize(9)
         table.scale(1.2, 1.5)
@@ -430,10 +637,12 @@ class AdvancedDownloadTester:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         mode_suffix = f"custom_{self.target_ip}" if self.custom_ip else "dns"
         filename = f"comparison_test_{self.hostname}_{mode_suffix}_{timestamp}.png"
-        plt.savefig(filename, dpi=300, bbox_inches='tight')
+        plt.savefig(filename, dpi=150, bbox_inches='tight')
         print(f"\n对比图表已保存为: {filename}")
         
-        plt.show()
+        if not HEADLESS:
+            plt.show()
+        plt.close(fig)
 
 def get_user_config():
     """获取用户配置"""
@@ -466,6 +675,21 @@ def get_user_config():
                 print("错误: IP地址格式无效，将使用DNS自动解析")
                 custom_ip = None
     
+    # HTTPS加密开销选项
+    fast_cipher = False
+    if url.startswith('https://'):
+        print("\nHTTPS选项:")
+        print("1. 默认TLS设置 (默认)")
+        print("2. 使用AES128-GCM加密套件 (降低解密开销，连接限制为TLS 1.2)")
+        print("3. 改用明文HTTP (需目标服务器支持http://)")
+        
+        tls_choice = input("请选择 (1-3，直接回车选择1): ").strip()
+        if tls_choice == '2':
+            fast_cipher = True
+        elif tls_choice == '3':
+            url = 'http://' + url[len('https://'):]
+            print(f"将使用明文链接: {url}")
+    
     # 选择测试模式
     print("\n测试模式选择:")
     print("1. 单次测试 (自定义线程数和时间)")
@@ -478,6 +702,7 @@ def get_user_config():
     config = {
         'url': url,
         'custom_ip': custom_ip,
+        'fast_cipher': fast_cipher,
         'mode': mode
     }
     
@@ -530,8 +755,14 @@ def main():
     if not config:
         return
     
-    # 创建测试器
-    tester = AdvancedDownloadTester(config['url'], config['custom_ip'])
+    # 创建测试器，连接池按本次运行会用到的最大线程数设置
+    max_threads = {
+        '1': config.get('threads'),
+        '2': 64,
+        '3': config.get('max_threads'),
+        '4': 128
+    }[config['mode']]
+    tester = AdvancedDownloadTester(config['url'], config['custom_ip'], max_threads, config['fast_cipher'])
     tester.get_target_ip()
     
     try: